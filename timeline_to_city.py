@@ -1,19 +1,63 @@
-import json
+import os
 import yaml
 import argparse
+import csv
 import time
 import re
-from datetime import datetime, timedelta
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
+import h3
+import ijson
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from geopy.adapters import RequestsAdapter
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
+from geopy.extra.rate_limiter import RateLimiter
 from tqdm import tqdm
 
 # Set up argument parser for command line usage
 parser = argparse.ArgumentParser(description='Process Google Timeline JSON history data.')
 parser.add_argument('json_file', type=str, help='Path to the JSON file containing location data.')
 parser.add_argument('--email', type=str, help='An email address to use for querying Nominatim (geolocation service).')
+parser.add_argument('--online', action='store_true', help='Query Nominatim instead of the offline GeoNames cities dataset.')
+parser.add_argument('--cities-file', type=str, default='cities1000.txt', help='Path to the GeoNames cities file used for offline geocoding.')
+parser.add_argument('--nominatim-domain', type=str, default='nominatim.openstreetmap.org', help='Domain of the Nominatim server to query with --online.')
+parser.add_argument('--nominatim-scheme', type=str, default='https', choices=['http', 'https'], help='Scheme used to connect to the Nominatim server.')
+parser.add_argument('--workers', type=int, default=8, help='Number of parallel Nominatim queries for a self-hosted server.')
 args = parser.parse_args()
 
+# The public Nominatim server allows at most one request per second
+NOMINATIM_PUBLIC_DOMAIN = 'nominatim.openstreetmap.org'
+NOMINATIM_PUBLIC_MIN_DELAY = 1.1
+# Seconds to wait for a Nominatim response before retrying; geopy's default of 1 second is too short for slow servers
+NOMINATIM_TIMEOUT = 15
+
+# Nominatim results are cached in SQLite, keyed by H3 cell, with hot entries kept in memory.
+# Resolution 8 cells (~530 m edge, ~0.74 km²) are well below city granularity; the resolution is part
+# of the file name so entries cached with another key scheme are not reused.
+CACHE_H3_RESOLUTION = 8
+CACHE_FILENAME = f'geocoding_cache_h3r{CACHE_H3_RESOLUTION}.sqlite'
+CACHE_MEMORY_SIZE = 4096
+cache_connection = None
+cache_lock = threading.Lock()
+geocoding_cache = OrderedDict()
+
+# Pattern for UTC offsets in the format ±HH:MM
+UTC_OFFSET_PATTERN = re.compile(r'^([+-])(\d{2}):(\d{2})$')
+
+# Buffer the TSV output so rows reach the file in large writes
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Timestamps are compared as integer nanoseconds since the epoch
+NANOSECONDS_PER_DAY = 86_400 * 10**9
+
 # Load configuration from a YAML file
 def load_config(file_path):
     with open(file_path, 'r') as file:
@@ -26,62 +70,129 @@ def validate_config(config):
     if 'date_range' not in config:
         raise ValueError("Config file must include 'date_range'.")
 
-    # Pattern for validating UTC offset format
-    utc_offset_pattern = re.compile(r'^[+-]\d{2}:\d{2}$')
     for range in config['date_range']:
         # Validate each date range in the config
         if 'start' not in range or 'end' not in range or 'closest_time' not in range:
             raise ValueError("Each date range must include 'start', 'end', and 'closest_time'.")
 
-        if 'UTC_offset' not in range or not utc_offset_pattern.match(range['UTC_offset']):
+        # Unquoted times such as 12:00:00 are read by YAML as integers, so require a string
+        if not isinstance(range['closest_time'], str):
+            raise ValueError("Each date range must include a quoted 'closest_time' in the format HH:MM:SS.")
+        parse_closest_time(range['closest_time'])
+
+        if 'UTC_offset' not in range or not UTC_OFFSET_PATTERN.match(range['UTC_offset']):
             raise ValueError("Each date range must include a valid 'UTC_offset' in the format ±HH:MM.")
 
-# Parse timestamps from the JSON file
-def parse_timestamp(timestamp_str):
-    try:
-        return datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%S.%fZ')
-    except ValueError:
-        return datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%SZ')
-
-# Extract data within the specified date range and adjust timestamps
-def extract_data(data, date_range):
-    adjusted_data = []
-    start_date = datetime.strptime(date_range['start'], '%Y-%m-%d').date()
-    end_date = datetime.strptime(date_range['end'], '%Y-%m-%d').date()
-    closest_time = datetime.strptime(date_range['closest_time'], '%H:%M:%S').time()
-
-    # Process UTC offset for time adjustment
+# Load location records into columns for vectorized processing, keeping only the fields we use
+def load_locations(records):
+    columns = ((record['timestamp'], record['latitudeE7'], record['longitudeE7']) for record in records)
+    locations = pd.DataFrame.from_records(columns, columns=['timestamp', 'latitudeE7', 'longitudeE7'])
+    if locations.empty:
+        sys.exit("No 'locations' records found in the JSON file; expected a Google Takeout Records.json.")
+    # Timestamps are UTC; keep them naive at nanosecond resolution so they can be handled as integers
+    locations['timestamp'] = pd.to_datetime(locations['timestamp'], utc=True, format='ISO8601').dt.tz_localize(None).dt.as_unit('ns')
+    return locations
+
+# Parse the UTC offset of a date range, e.g. '-04:00'
+def parse_utc_offset(date_range):
     utc_offset = date_range.get('UTC_offset', '+00:00')
-    offset_hours, offset_minutes = map(int, re.match(r'([+-]\d{2}):(\d{2})', utc_offset).groups())
-    offset = timedelta(hours=offset_hours, minutes=offset_minutes)
+    sign, offset_hours, offset_minutes = UTC_OFFSET_PATTERN.match(utc_offset).groups()
+    # The sign applies to the whole offset, e.g. '-03:30' is minus three and a half hours
+    offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+    return -offset if sign == '-' else offset
+
+# Parse a closest time in the format HH:MM:SS into nanoseconds since midnight
+def parse_closest_time(closest_time):
+    parsed_time = datetime.strptime(closest_time, '%H:%M:%S').time()
+    return ((parsed_time.hour * 60 + parsed_time.minute) * 60 + parsed_time.second) * 10**9
+
+# Parse the date ranges from the config once into arrays with one entry per range
+def parse_date_ranges(date_ranges):
+    start_days = np.array([date.fromisoformat(date_range['start']) for date_range in date_ranges], dtype='datetime64[D]').astype(np.int64)
+    end_days = np.array([date.fromisoformat(date_range['end']) for date_range in date_ranges], dtype='datetime64[D]').astype(np.int64)
+    closest_times = np.array([parse_closest_time(date_range['closest_time']) for date_range in date_ranges], dtype=np.int64)
+    offsets = np.array([pd.Timedelta(parse_utc_offset(date_range)).as_unit('ns').value for date_range in date_ranges], dtype=np.int64)
+    return start_days, end_days, closest_times, offsets
 
-    # Adjust timestamps for each location record
-    for record in tqdm(data['locations'], desc="Adjusting Data"):
-        timestamp = parse_timestamp(record['timestamp'])
-        timestamp_adjusted = timestamp + offset
+# Extract data within each of the specified date ranges and adjust timestamps
+def extract_data(locations, date_ranges):
+    start_days, end_days, closest_times, offsets = parse_date_ranges(date_ranges)
 
-        if start_date <= timestamp_adjusted.date() <= end_date:
-            record['timestamp_adjusted'] = timestamp_adjusted
-            time_difference = abs(datetime.combine(timestamp_adjusted.date(), closest_time) - timestamp_adjusted)
-            record['time_difference'] = time_difference
-            adjusted_data.append(record)
+    # Adjust timestamps for all location records and all date ranges at once as integer
+    # nanoseconds (one row per range), split into day number and time of day, and mark
+    # the records within each date range
+    timestamps = locations['timestamp'].to_numpy().astype(np.int64)
+    days, times_of_day = np.divmod(timestamps + offsets[:, None], NANOSECONDS_PER_DAY)
+    in_range = (days >= start_days[:, None]) & (days <= end_days[:, None])
 
-    # Sort data and select the closest record for each day
-    adjusted_data.sort(key=lambda x: (x['timestamp_adjusted'].date(), x['time_difference']))
-    unique_days = {}
-    for record in adjusted_data:
-        day = record['timestamp_adjusted'].date()
-        if day not in unique_days or unique_days[day]['time_difference'] > record['time_difference']:
-            unique_days[day] = record
+    extracted_ranges = []
+    for range_index, offset in enumerate(offsets):
+        indices = np.flatnonzero(in_range[range_index])
+        range_days = days[range_index, indices]
+        time_differences = np.abs(times_of_day[range_index, indices] - closest_times[range_index])
 
-    final_data = list(unique_days.values())
-    final_data.sort(key=lambda x: x['timestamp_adjusted'].date())
+        # Select the closest record for each day, ordered by day: sort by (day, time difference)
+        # on primitive arrays and keep the first record of each day
+        order = np.lexsort((time_differences, range_days))
+        _, first_of_day = np.unique(range_days[order], return_index=True)
+        closest = indices[order[first_of_day]]
+        final_data = locations.iloc[closest].assign(timestamp_adjusted=locations['timestamp'].iloc[closest] + pd.Timedelta(offset))
+        extracted_ranges.append(final_data.to_dict('records'))
 
-    return final_data
+    return extracted_ranges
+
+# Convert latitude and longitude in degrees to 3D unit vectors on the sphere
+def unit_vectors(latitude, longitude):
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+# Load a GeoNames lookup table (e.g. admin1CodesASCII.txt) mapping a code column to a name column
+def load_geonames_names(file_path, code_column, name_column):
+    names = {}
+    if not os.path.exists(file_path):
+        return names
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            names[fields[code_column]] = fields[name_column]
+    return names
+
+# Offline reverse geocoder over the GeoNames cities dataset using a KD-tree
+class LocalReverseGeocoder:
+    def __init__(self, cities_file):
+        # Optional GeoNames tables next to the cities file turn codes into readable names
+        directory = os.path.dirname(cities_file)
+        admin1_names = load_geonames_names(os.path.join(directory, 'admin1CodesASCII.txt'), 0, 1)
+        country_names = load_geonames_names(os.path.join(directory, 'countryInfo.txt'), 0, 4)
+
+        lats, lons, names = [], [], []
+        with open(cities_file, 'r', encoding='utf-8') as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                city, country_code, admin1_code = fields[1], fields[8], fields[10]
+                state = admin1_names.get(f"{country_code}.{admin1_code}", admin1_code)
+                country = country_names.get(country_code, country_code)
+                lats.append(float(fields[4]))
+                lons.append(float(fields[5]))
+                names.append(', '.join(filter(None, [city, state, country])))
+
+        # Keep cities as parallel arrays and index their unit vectors once
+        self.lats = np.array(lats, dtype=np.float32)
+        self.lons = np.array(lons, dtype=np.float32)
+        self.names = np.array(names, dtype=object)
+        self.tree = cKDTree(unit_vectors(self.lats, self.lons))
+
+    # Get the name of the nearest city to the given coordinates, or an array of names for arrays of coordinates
+    def reverse(self, latitude, longitude):
+        _, idx = self.tree.query(unit_vectors(latitude, longitude))
+        return self.names[idx]
 
 # Get closest city name from latitude and longitude using Nominatim
-def get_closest_city_name(latitude, longitude, geolocator, email):
-    location = geolocator.reverse((latitude, longitude), exactly_one=True)
+def get_closest_city_name(latitude, longitude, reverse):
+    location = reverse((latitude, longitude), exactly_one=True)
     if location:
         address = location.raw.get('address', {})
         city = address.get('city') or address.get('town') or address.get('hamlet') or address.get('township') or address.get('village') or address.get('suburb')
@@ -97,56 +208,132 @@ def get_closest_city_name(latitude, longitude, geolocator, email):
     else:
         return None
 
-# Query Nominatim with retries in case of timeout
-def query_nominatim(latitude, longitude, geolocator, email, attempt=1, max_attempts=5):
-    # Sleep briefly between queries to comply with Nominatim's usage policy
-    for _ in range(30):
-        time.sleep(0.1)
-    try:
-        return get_closest_city_name(latitude, longitude, geolocator, email)
-    except GeocoderTimedOut:
-        if attempt <= max_attempts:
-            print(f"Retrying {attempt}/{max_attempts} for coordinates: {latitude}, {longitude}")
-            time.sleep(3)
-            return query_nominatim(latitude, longitude, geolocator, email, attempt + 1)
-        else:
-            print(f"Failed to geocode coordinates: {latitude}, {longitude} after {max_attempts} attempts.")
+# Query Nominatim with retries in case of timeout, backing off exponentially between attempts
+def query_nominatim(latitude, longitude, reverse, max_attempts=5):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return get_closest_city_name(latitude, longitude, reverse)
+        except GeocoderTimedOut:
+            if attempt < max_attempts:
+                print(f"Retrying {attempt}/{max_attempts - 1} for coordinates: {latitude}, {longitude}")
+                time.sleep(2 ** attempt)
+        except KeyboardInterrupt:
+            sys.exit("Script interrupted by user.")
+        except Exception as e:
+            print(f"An error occurred: {e}")
             return None
-    except KeyboardInterrupt:
-        sys.exit("Script interrupted by user.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+
+    print(f"Failed to geocode coordinates: {latitude}, {longitude} after {max_attempts} attempts.")
+    return None
+
+# Open the geocoding cache, creating it if needed; repeated calls reuse the open connection
+def load_cache():
+    global cache_connection
+    if cache_connection is not None:
+        return
+    cache_connection = sqlite3.connect(CACHE_FILENAME, check_same_thread=False)
+    cache_connection.execute('PRAGMA journal_mode=WAL')
+    cache_connection.execute('PRAGMA synchronous=NORMAL')
+    cache_connection.execute('CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value TEXT)')
+    cache_connection.commit()
+
+# Keep a cache entry in memory, evicting the least recently used one when full
+def remember_location(cache_key, location_string):
+    geocoding_cache[cache_key] = location_string
+    geocoding_cache.move_to_end(cache_key)
+    if len(geocoding_cache) > CACHE_MEMORY_SIZE:
+        geocoding_cache.popitem(last=False)
+
+# Get the cache key for coordinates
+def get_cache_key(latitude, longitude):
+    return h3.latlng_to_cell(latitude, longitude, CACHE_H3_RESOLUTION)
+
+# Get a cached location name, or None if the key has not been geocoded yet
+def get_cached_location(cache_key):
+    with cache_lock:
+        if cache_key in geocoding_cache:
+            geocoding_cache.move_to_end(cache_key)
+            return geocoding_cache[cache_key]
+        row = cache_connection.execute('SELECT value FROM cache WHERE key = ?', (cache_key,)).fetchone()
+        if row is not None:
+            remember_location(cache_key, row[0])
+            return row[0]
+    return None
+
+# Get the location name for coordinates from the cache, querying Nominatim on a miss
+def get_location_with_cache(latitude, longitude, reverse):
+    cache_key = get_cache_key(latitude, longitude)
+    location_string = get_cached_location(cache_key)
+    if location_string is not None:
+        return location_string
+
+    location_string = query_nominatim(latitude, longitude, reverse)
+    # Only cache successful lookups so failures are retried on the next run
+    if location_string is not None:
+        with cache_lock:
+            cache_connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?)', (cache_key, location_string))
+            cache_connection.commit()
+            remember_location(cache_key, location_string)
+    return location_string
 
 # Main script execution
 if __name__ == "__main__":
     # Load configuration and set up geolocator
     config = load_config('config.yaml')
-    geolocator = Nominatim(user_agent=args.email)
-
-    # Read the JSON file containing location data
-    with open(args.json_file, 'r') as file:
-        data = json.load(file)
-
-    # Prepare the TSV file for writing processed data
-    with open('output.tsv', 'w') as tsv_file:
-        pass  # Clear existing contents
-
-    # Process data and append to TSV file
-    with open('output.tsv', 'a') as tsv_file:
-        for date_range in config['date_range']:
-            extracted_data = extract_data(data, date_range)
-
-            for record in tqdm(extracted_data, desc="Writing to TSV"):
-                # Convert latitude and longitude to decimal format
-                latitude = record['latitudeE7'] / 1e7
-                longitude = record['longitudeE7'] / 1e7
-                # Query Nominatim for city name
-                city_name = query_nominatim(latitude, longitude, geolocator, args.email)
-                
-                # Write each record to the TSV file using the adjusted timestamp
-                adjusted_timestamp_str = record['timestamp_adjusted'].strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-                tsv_line = '\t'.join(map(str, [adjusted_timestamp_str, latitude, longitude, city_name]))
-                tsv_file.write(tsv_line + '\n')
+    if args.online:
+        load_cache()
+        # Throttle the public server to its usage policy; self-hosted servers can be queried in parallel
+        public_server = args.nominatim_domain == NOMINATIM_PUBLIC_DOMAIN
+        workers = 1 if public_server else args.workers
+        # Share one requests session so every worker reuses a pooled keep-alive connection
+        adapter_factory = partial(RequestsAdapter, pool_maxsize=workers)
+        geolocator = Nominatim(user_agent=args.email, domain=args.nominatim_domain, scheme=args.nominatim_scheme, timeout=NOMINATIM_TIMEOUT, adapter_factory=adapter_factory)
+        if public_server:
+            reverse = RateLimiter(geolocator.reverse, min_delay_seconds=NOMINATIM_PUBLIC_MIN_DELAY, max_retries=0, swallow_exceptions=False)
+        else:
+            reverse = geolocator.reverse
+    else:
+        if not os.path.exists(args.cities_file):
+            sys.exit(f"Cities file not found: {args.cities_file}. Download and extract "
+                     "https://download.geonames.org/export/dump/cities1000.zip, pass --cities-file, "
+                     "or use --online to query Nominatim instead.")
+        geocoder = LocalReverseGeocoder(args.cities_file)
+
+    # Stream the location records from the JSON file rather than loading it all into memory
+    with open(args.json_file, 'rb') as file:
+        locations = load_locations(ijson.items(file, 'locations.item'))
+
+    # Extract the records for every date range before geocoding any of them
+    extracted_ranges = extract_data(locations, config['date_range'])
+    records = [record for extracted_data in extracted_ranges for record in extracted_data]
+    # Convert latitude and longitude to decimal format
+    latitudes = np.array([record['latitudeE7'] for record in records], dtype=np.float64) / 1e7
+    longitudes = np.array([record['longitudeE7'] for record in records], dtype=np.float64) / 1e7
+
+    # Look up the city names offline, or query Nominatim when requested
+    if args.online:
+        # Geocode each uncached location only once, even if it appears in several date ranges
+        cache_keys = [get_cache_key(latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+        unique_coordinates = dict(zip(cache_keys, zip(latitudes, longitudes)))
+        locations_by_key = {cache_key: get_cached_location(cache_key) for cache_key in unique_coordinates}
+        pending_keys = [cache_key for cache_key, location_string in locations_by_key.items() if location_string is None]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda cache_key: get_location_with_cache(*unique_coordinates[cache_key], reverse), pending_keys)
+            for cache_key, location_string in zip(pending_keys, tqdm(results, total=len(pending_keys), desc="Geocoding")):
+                locations_by_key[cache_key] = location_string
+
+        city_names = [locations_by_key[cache_key] for cache_key in cache_keys]
+    else:
+        city_names = geocoder.reverse(latitudes, longitudes) if records else []
+
+    # Write each record to the TSV file using the adjusted timestamp
+    rows = (
+        (record['timestamp_adjusted'].strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z', latitude, longitude, city_name)
+        for record, latitude, longitude, city_name in zip(tqdm(records, desc="Writing to TSV"), latitudes, longitudes, city_names)
+    )
+    with open('output.tsv', 'w', encoding='utf-8', newline='', buffering=OUTPUT_BUFFER_SIZE) as tsv_file:
+        # Write plain TSV without CSV quoting so location names appear verbatim
+        csv.writer(tsv_file, delimiter='\t', lineterminator='\n', quoting=csv.QUOTE_NONE, quotechar=None, escapechar='\\').writerows(rows)
 
     print("Data processing complete. Output saved to 'output.tsv'.")
\ No newline at end of file